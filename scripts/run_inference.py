@@ -9,7 +9,7 @@ from codecarbon import EmissionsTracker
 
 from src.utils.setup import ensure_dir_exists, set_seed, ensure_cpu_in_codecarbon
 from src.utils.logs import log_inference_to_wandb, log_gpu_info
-from src.models.ollama_utils import query_ollama_sc, check_if_ollama_model_exists, track_samples_ollama
+from src.models.ollama_utils import query_ollama_sc, check_if_ollama_model_exists, track_samples_ollama, warmup_ollama_model
 from src.models.hf_utils import HF_Manager
 from src.evaluation.evaluate import evaluate_performance
 from src.data.data_manager import load_data, save_model_outputs
@@ -99,6 +99,7 @@ def main():
 
     if args.use_ollama:
         check_if_ollama_model_exists(args.model_name)
+        warmup_ollama_model(args.model_name, args.dataset) # load the weights before the emissions tracker starts
         tracker, num_queries, prompts, true_labels, pred_labels = run_inference_ollama(
             model_name=args.model_name, 
             dataset_name=args.dataset,
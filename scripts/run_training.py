@@ -74,6 +74,8 @@ def run_training(student_model: str, teacher_model: str, dataset_name: str, infe
     except Exception as e:
         print(f"Error during prediction: {e}")
         return model_output_dir
+    finally:
+        HF_Manager.clear_pipeline_cache() # free the predict pipeline next to the training model
 
     return model_output_dir
 
@@ -13,20 +13,30 @@ class KeywordStoppingCriteria(StoppingCriteria):
             ids = tokenizer.encode(keyword, add_special_tokens=False)
             if len(ids) > 0:  # Some tokenizers might split a word into multiple tokens
                 self.keyword_ids.append(ids)
+
+        # Precompute lowercased keywords and the size of the window to decode.
+        # Every generated token decodes to at least one character, so the last
+        # max_keyword_len tokens always cover a keyword that has just been completed.
+        self.lower_keywords = [keyword.lower() for keyword in keywords]
+        self.max_keyword_len = max((len(keyword) for keyword in keywords), default=0)
         
     def __call__(self, input_ids, scores, **kwargs):
         # Only look at generated tokens (ignore prompt)
-        generated_ids = input_ids[0][self.prompt_length:]
+        generated_length = input_ids.shape[1] - self.prompt_length
         
-        if self.max_tokens is not None and len(generated_ids) > self.max_tokens:
+        if self.max_tokens is not None and generated_length > self.max_tokens:
             return True
+
+        if generated_length <= 0 or self.max_keyword_len == 0:
+            return False
             
-        # Convert to string to check for keywords
-        generated_text = self.tokenizer.decode(generated_ids).lower()
+        # Convert only the tail of the generation to string to check for keywords
+        window_start = max(self.prompt_length, input_ids.shape[1] - self.max_keyword_len)
+        generated_tail = self.tokenizer.decode(input_ids[0][window_start:]).lower()
         
         # Stop if we see any stopping pattern
-        for keyword in self.keywords:
-            if keyword in generated_text.lower():
+        for keyword in self.lower_keywords:
+            if keyword in generated_tail:
                 return True
                 
-        return False
\ No newline at end of file
+        return False
@@ -1,10 +1,12 @@
 import os
+import gc
 import torch
+import functools
 import weave
 from tqdm import tqdm
 from transformers import pipeline
-from peft import LoraConfig, TaskType, get_peft_model
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from peft import LoraConfig, TaskType, get_peft_model, prepare_model_for_kbit_training
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 from transformers.generation.stopping_criteria import StoppingCriteriaList
 
 from src.models.hf_stopping import KeywordStoppingCriteria
@@ -12,14 +14,165 @@ from src.prompts.sentiment import get_sentiment_prompt
 from src.prompts.gold import get_gold_classification_prompt
 from src.prompts.summary import get_summmary_prompt
 from src.models.model_mapping import model_mapping
-from src.models.query_utils import find_majority, clean_llm_output, get_query_params
+from src.models.query_utils import find_majority, clean_llm_output, get_query_params, get_dataset_family
 from src.data.data_manager import get_samples
 
+# Stop generating once one of these keywords appears in the output
+STOP_WORDS = {
+    "sentiment": ["text:"],
+    "gold": ["end of classification", "}"],
+    "summary": ["please let me know if", "i hope it is correct"],
+}
+
+def _get_stop_word_variants(family):
+    """
+    Common case variants (lower, capitalized, title, upper) of the stop words of a dataset family.
+    vLLM matches stop strings case-sensitively, while KeywordStoppingCriteria ignores case. Mixed-case outputs
+    such as "End of Classification" are not in this list, so vLLM can generate past them. _truncate_at_stop_word
+    then cuts the output so that it matches what the HF backend returns.
+    """
+    variants = set()
+    for stop_word in STOP_WORDS[family]:
+        variants.update((stop_word, stop_word.capitalize(), stop_word.title(), stop_word.upper()))
+    return sorted(variants)
+
+def _truncate_at_stop_word(text, family):
+    """
+    Cut a completion after the first stop word, ignoring case, like KeywordStoppingCriteria does during generation.
+    """
+    lower_text = text.lower()
+    positions = [lower_text.find(stop_word) + len(stop_word) for stop_word in STOP_WORDS[family] if stop_word in lower_text]
+    return text[:min(positions)] if positions else text
+
+# Per-family cap on generated tokens, overriding max_new_tokens from the query params.
+# A sentiment label is a single word, so a few tokens are enough
+_MAX_NEW_TOKENS = {
+    "sentiment": 4,
+}
+
+SENTIMENT_WORDS = ["positive", "negative", "neutral"]
+
+@functools.lru_cache(maxsize=4)
+def _get_sentiment_word_token_ids(tokenizer):
+    """
+    Token ids of sentiment labels that are encoded as a single token, so that emitting one of them can end generation.
+    Labels split into several tokens are skipped, stopping on their first piece would cut the label off.
+    """
+    token_ids = set()
+    for word in SENTIMENT_WORDS:
+        for variant in (word, f" {word}", word.capitalize(), f" {word.capitalize()}"):
+            ids = tokenizer.encode(variant, add_special_tokens=False)
+            if len(ids) == 1:
+                token_ids.add(ids[0])
+    return sorted(token_ids)
+
+_DTYPES = {
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+    "fp32": torch.float32,
+}
+
+# Only one pipeline is kept resident, clear it with HF_Manager.clear_pipeline_cache() to free GPU memory
+@functools.lru_cache(maxsize=1)
+def _get_pipeline(model_path, dtype_str, device):
+    """
+    Build a text-generation pipeline once per (model_path, dtype, device) and reuse it across calls.
+
+    Args:
+        model_path (str): Local path or Hugging Face name of the model.
+        dtype_str (str): One of the keys in _DTYPES, e.g. "bf16".
+        device (str): Value passed as device_map, e.g. "auto".
+
+    Returns:
+        transformers.Pipeline: The cached text-generation pipeline.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    # Batched generation with a causal LM requires left padding
+    tokenizer.padding_side = "left"
+    return pipeline(
+        model=model_path,
+        tokenizer=tokenizer,
+        task="text-generation",
+        torch_dtype=_DTYPES[dtype_str],
+        device_map=device,
+        )
+
+def _maybe_compile(model, compile_model: bool = False):
+    """
+    Opt-in: compile the forward pass of a model for faster decoding on CUDA.
+    Compilation happens during the first generate calls, so warm the model up before any measured run.
+    Models without static KV cache support (e.g. OPT) are left uncompiled.
+    """
+    if not compile_model or not torch.cuda.is_available():
+        return model
+
+    # PEFT models generate through the underlying *ForCausalLM, so that is the forward to compile
+    target = model.get_base_model() if hasattr(model, "get_base_model") else model
+    if not getattr(target, "_supports_static_cache", False):
+        print(f"Model {target.config._name_or_path} does not support a static KV cache. Skipping torch.compile.")
+        return model
+
+    print("Compiling model forward pass with torch.compile.")
+    # A static KV cache keeps the decode shapes fixed, so CUDA graphs are not re-recorded every step
+    target.generation_config.cache_implementation = "static"
+    target.forward = torch.compile(target.forward, mode="reduce-overhead")
+    return model
+
+def _from_pretrained(model_class, model_name, torch_dtype, **kwargs):
+    """
+    Load a model with FlashAttention-2 when running in half precision on CUDA. If the architecture, the flash_attn
+    package or the device placement does not support it, retry with the transformers default attention implementation.
+    """
+    if torch.cuda.is_available() and torch_dtype in (torch.bfloat16, torch.float16):
+        try:
+            model = model_class.from_pretrained(model_name, torch_dtype=torch_dtype, attn_implementation="flash_attention_2", **kwargs)
+            print("Using attention implementation: flash_attention_2")
+            return model
+        except (ImportError, ValueError) as e:
+            print(f"FlashAttention-2 not available ({e}). Using the default attention implementation.")
+    return model_class.from_pretrained(model_name, torch_dtype=torch_dtype, **kwargs)
+
+def _cache_device(model):
+    """
+    Store the device of the model once after loading so that queries do not have to resolve it on every call.
+    """
+    # For models distributed across multiple devices, use the device of the first parameter
+    model._cached_device = model.device if hasattr(model, "device") else next(model.parameters()).device
+    return model
+
+def _get_model_device(model):
+    # Move inputs to the same device as the models first parameter
+    return getattr(model, "_cached_device", None) or next(model.parameters()).device
+
+def _tokenize_to_device(tokenizer, prompt, device):
+    inputs = tokenizer(prompt, return_tensors="pt")
+    if torch.device(device).type == "cuda":
+        # Copies from pinned host memory are asynchronous, so the transfer overlaps with kernel launches
+        return {k: v.pin_memory().to(device, non_blocking=True) for k, v in inputs.items()}
+    return {k: v.to(device) for k, v in inputs.items()}
+
 class HF_Manager:
+
+    @staticmethod
+    def preload(model_path, dtype: str = "bf16"):
+        """
+        Load the pipeline for a model ahead of time so the first inference is not slowed down by loading the weights.
+        """
+        return _get_pipeline(model_path, dtype, "auto")
+
+    @staticmethod
+    def clear_pipeline_cache():
+        """
+        Drop the cached pipeline and release its GPU memory.
+        """
+        _get_pipeline.cache_clear()
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
     
     @weave.op()
     @staticmethod
-    def predict(model_path, dataset, dataset_name, wandb_run=None, limit=5):
+    def predict(model_path, dataset, dataset_name, wandb_run=None, limit=5, dtype: str = "bf16"):
         params = get_query_params(dataset_name)
         # remove ['custom_max_retries', 'custom_retry_delay'] from params because they are not needed downstream and cause ValueErrors
         if "custom_max_retries" in params:
@@ -29,13 +182,17 @@ class HF_Manager:
         if "max_context_length" in params:
             params.pop("max_context_length", None)
 
-        pipe = pipeline(
-            model=model_path,
-            task="text-generation",
-            )
+        pipe = _get_pipeline(model_path, dtype, "auto")
+
+        # Batched generation needs a pad token
+        # (config.eos_token_id can be a list, e.g. for Llama 3, so reuse the tokenizer's single EOS token)
+        if pipe.tokenizer.pad_token_id is None:
+            pipe.tokenizer.pad_token = pipe.tokenizer.eos_token
 
         print(f"Running test inference with model {model_path} on dataset {dataset.shape}. Limit: {limit}.")
-        for i, example in tqdm(enumerate(dataset), total=min(limit, len(dataset))):
+        # First pass: build all prompts up to the limit
+        prompts, separators, meta = [], [], []
+        for i, example in enumerate(dataset):
             if i >= limit:
                 break
             if "sentiment" in dataset_name:
@@ -50,13 +207,25 @@ class HF_Manager:
                 text = example["text"]
                 prompt = get_summmary_prompt(text)
                 prompt_separator = "FINAL SUMMARY OF YOUR TEXT: "
-            completion = pipe(prompt, **params)
+            prompts.append(prompt)
+            separators.append(prompt_separator)
+            meta.append(i)
+
+        if not prompts:
+            return
+
+        # Second pass: let the pipeline pad-batch all prompts on the device
+        batch_size = min(limit, 32)
+        # return_full_text=False returns only the completion, the prompt (which ends with the separator) is not echoed back
+        # Passing a generator makes the pipeline yield outputs as each batch finishes, so the progress bar tracks generation
+        outputs = pipe((prompt for prompt in prompts), batch_size=batch_size, return_full_text=False, **params)
+        for i, prompt, prompt_separator, completion in tqdm(zip(meta, prompts, separators, outputs), total=len(prompts)):
             completion = completion[0]["generated_text"]
+            # The model may still repeat the separator, in that case keep only what follows it
             label_pos = completion.find(prompt_separator)
-            if label_pos == -1:
-                print("Label not found in completion.")
-                continue
-            completion = completion[label_pos + len(prompt_separator):].strip()
+            if label_pos != -1:
+                completion = completion[label_pos + len(prompt_separator):]
+            completion = completion.strip()
             print(f"Example {i}:")
             print(f"Prompt: {prompt}")
             print(f"Completion by student: {completion}")
@@ -70,67 +239,71 @@ class HF_Manager:
                     })
             
     @staticmethod 
-    def query_hf_sc(model, tokenizer, dataset_name, prompt, verbose=False):
+    def query_hf_sc(model, tokenizer, dataset_name, prompt, verbose=False, num_samples=1):
         query_params = get_query_params(dataset_name)
+
+        # Tokenize once and reuse the same input tensors for every self-consistency sample
+        inputs = _tokenize_to_device(tokenizer, prompt, _get_model_device(model))
+        prompt_length = inputs["input_ids"].shape[1]
         
-        response = HF_Manager.query_model(model, tokenizer, dataset_name, prompt, query_params)
-        cleaned_response = clean_llm_output(dataset_name, response)
-        if verbose:
-            print(f"Response: {response}")
-            print(f"Cleaned Response: {cleaned_response}")
-            print(f"-----------")
+        cleaned_responses = []
+        for _ in range(num_samples):
+            response = HF_Manager.query_model_preenc(model, tokenizer, dataset_name, inputs, prompt_length, query_params)
+            cleaned_response = clean_llm_output(dataset_name, response)
+            if verbose:
+                print(f"Response: {response}")
+                print(f"Cleaned Response: {cleaned_response}")
+                print(f"-----------")
+            cleaned_responses.append(cleaned_response)
         
-        return cleaned_response
+        if num_samples == 1:
+            return cleaned_responses[0]
+        return find_majority(cleaned_responses, dataset_name)
 
     @staticmethod
     def query_model(model, tokenizer, dataset_name, prompt, params):
-        device = "cuda:0" if torch.cuda.is_available() else "cpu"
-
         # Tokenize the input prompt and move to the appropriate device
-        inputs = tokenizer(prompt, return_tensors="pt")
-        # Move inputs to the same device as the models first parameter
-        if hasattr(model, "device"):
-            device = model.device
-        else:
-            # For models distributed across multiple devices, get device of first parameter
-            param_device = next(model.parameters()).device
-            device = param_device
-            
-        inputs = {k: v.to(device) for k, v in inputs.items()}
-
+        inputs = _tokenize_to_device(tokenizer, prompt, _get_model_device(model))
         prompt_length = inputs["input_ids"].shape[1]
 
+        return HF_Manager.query_model_preenc(model, tokenizer, dataset_name, inputs, prompt_length, params)
+
+    @staticmethod
+    def query_model_preenc(model, tokenizer, dataset_name, inputs, prompt_length, params):
+        """
+        Generate a response for an already tokenized prompt whose tensors are on the model device.
+        """
         # Create stopping criteria - stop on seeing these keywords or patterns
-        if "sentiment" in dataset_name:
-            stop_words = ["text:"]
-            stopping_criteria = StoppingCriteriaList([
-                KeywordStoppingCriteria(tokenizer, stop_words, prompt_length, max_tokens=3)
-            ])
-        elif "gold" in dataset_name:
-            stop_words = ["end of classification", "}"]
-            stopping_criteria = StoppingCriteriaList([
-                KeywordStoppingCriteria(tokenizer, stop_words, prompt_length, max_tokens=None)
-            ])
-        elif "summary" in dataset_name:
-            stop_words = ["please let me know if", "i hope it is correct"]
-            stopping_criteria = StoppingCriteriaList([
-                KeywordStoppingCriteria(tokenizer, stop_words, prompt_length, max_tokens=None)
-            ])
-        else:
-            stopping_criteria = None
+        family = get_dataset_family(dataset_name)
+        max_tokens = 3 if family == "sentiment" else None
+        stopping_criteria = StoppingCriteriaList([
+            KeywordStoppingCriteria(tokenizer, STOP_WORDS[family], prompt_length, max_tokens=max_tokens)
+        ])
+
+        max_new_tokens = _MAX_NEW_TOKENS.get(family, params.get("max_new_tokens"))
+        eos_token_id = tokenizer.eos_token_id
+        if family == "sentiment":
+            # Stop as soon as a complete sentiment label has been generated
+            eos_token_id = [token_id for token_id in (tokenizer.eos_token_id, *_get_sentiment_word_token_ids(tokenizer)) if token_id is not None]
+
+        generate_kwargs = {}
+        if params.get("do_sample") is False:
+            generate_kwargs["num_beams"] = 1 # keep greedy decoding on the compiled graph
 
         # Generate a response
         with torch.no_grad():
             outputs = model.generate(**inputs,
+                                    use_cache=True,
                                     do_sample=params.get("do_sample"),
                                     temperature=params.get("temperature"),
                                     top_p=params.get("top_p"),
                                     top_k=params.get("top_k"),
-                                    max_new_tokens=params.get("max_new_tokens"),
+                                    max_new_tokens=max_new_tokens,
                                     # pad_token_id=tokenizer.eos_token_id, # previous implementation which caused issues. It doesn't match the setup in load_model
                                     pad_token_id=tokenizer.pad_token_id,
-                                    eos_token_id=tokenizer.eos_token_id,
+                                    eos_token_id=eos_token_id,
                                     stopping_criteria=stopping_criteria,
+                                    **generate_kwargs,
                                     )
 
         # Decode ONLY the generated tokens (exclude the input prompt tokens)
@@ -139,7 +312,82 @@ class HF_Manager:
         return response
 
     @staticmethod
-    def load_model(model_name: str, peft: bool):
+    def load_model_vllm(model_name: str, max_num_seqs: int = 16):
+        """
+        Load a model with the vLLM engine (PagedAttention, continuous batching). Requires the vllm package.
+
+        Args:
+            model_name (str): Local path, Hugging Face name or key in model_mapping.
+            max_num_seqs (int): Maximum number of sequences per batch. Kept low for single-tenant runs.
+
+        Returns:
+            vllm.LLM: The vLLM engine handle.
+        """
+        from vllm import LLM
+
+        if not os.path.exists(model_name) and model_name in model_mapping:
+            model_name = model_mapping[model_name]["HF"]
+        print(f"Loading model {model_name} with vLLM.")
+
+        return LLM(model=model_name, dtype="bfloat16", max_num_seqs=max_num_seqs)
+
+    @staticmethod
+    def query_model_vllm(llm, dataset_name, prompts, params):
+        """
+        Generate completions for a batch of prompts with a vLLM engine.
+
+        Args:
+            llm (vllm.LLM): The engine returned by load_model_vllm.
+            dataset_name (str): The name of the dataset, used to select stop words.
+            prompts (list): List of prompts to complete.
+            params (dict): Query parameters as returned by get_query_params.
+
+        Returns:
+            list: The generated text for each prompt, in input order.
+        """
+        from vllm import SamplingParams
+
+        family = get_dataset_family(dataset_name)
+        sampling_params = SamplingParams(
+            temperature=params.get("temperature") if params.get("do_sample", True) else 0.0,
+            top_p=params.get("top_p"),
+            top_k=params.get("top_k"),
+            seed=params.get("seed"),
+            max_tokens=_MAX_NEW_TOKENS.get(family, params.get("max_new_tokens")),
+            stop=_get_stop_word_variants(family),
+            include_stop_str_in_output=True, # keep e.g. the closing "}" of gold outputs, like the HF path
+            )
+        outputs = llm.generate(prompts, sampling_params)
+        return [_truncate_at_stop_word(output.outputs[0].text, family) for output in outputs]
+
+    @staticmethod
+    def get_quantization_config(quant: str = None):
+        """
+        Build a bitsandbytes quantization config. Requires the bitsandbytes package.
+        Accuracy impact of int8 / nf4 weights is small for inference and QLoRA-style fine-tuning.
+
+        Args:
+            quant (str, optional): "int8", "nf4" or None for no quantization.
+
+        Returns:
+            BitsAndBytesConfig or None: The quantization config.
+        """
+        if quant is None:
+            return None
+        elif quant == "int8":
+            return BitsAndBytesConfig(load_in_8bit=True, llm_int8_threshold=6.0)
+        elif quant == "nf4":
+            return BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+                bnb_4bit_use_double_quant=True,
+                )
+        else:
+            raise ValueError(f"Unknown quantization type: {quant}")
+
+    @staticmethod
+    def load_model(model_name: str, peft: bool, quant: str = None, dtype: str = None, compile_model: bool = False):
         # if model name is not a valid path
         if not os.path.exists(model_name):
             print(f"Model name {model_name} is not a valid path. Checking model mapping.")
@@ -149,10 +397,24 @@ class HF_Manager:
         else:
             print(f"Model name {model_name} is a valid path. Loading model from local path.")
 
-        model = AutoModelForCausalLM.from_pretrained(model_name, 
-                                                     device_map="auto" # very important for large models!
-                                                     )
+        bnb_config = HF_Manager.get_quantization_config(quant)
+        if bnb_config is not None:
+            print(f"Loading model {model_name} with {quant} quantization.")
+
+        # Half precision is only the default for inference. PEFT training stays in fp32 unless the SFTConfig enables mixed precision (bf16/fp16)
+        if dtype is None:
+            dtype = "fp32" if peft else "bf16"
+        torch_dtype = _DTYPES[dtype]
+
+        model = _from_pretrained(AutoModelForCausalLM, model_name, 
+                                 torch_dtype=torch_dtype, # bf16 by default for inference, use "fp16" on GPUs without bf16 support (e.g. Volta)
+                                 device_map="auto", # very important for large models!
+                                 quantization_config=bnb_config,
+                                 low_cpu_mem_usage=True, # load weights directly in the target dtype
+                                 )
         tokenizer = AutoTokenizer.from_pretrained(model_name)
+        if not peft:
+            tokenizer.padding_side = "left" # keep attention masks consistent for batched generation
 
         if "opt" in model_name:
             print(f"Loading OPT model {model_name}. Note: OPT adds EOS token at prompt beginning.")
@@ -187,13 +449,19 @@ class HF_Manager:
                 modules_to_save=["lm_head", "embed_tokens"],
             )
             print(f"Loaded model {model_name} with PEFT configuration.")
+            if bnb_config is not None:
+                model = prepare_model_for_kbit_training(model)
             model = get_peft_model(model, peft_config)
             model.print_trainable_parameters()
+        else:
+            model = _maybe_compile(model, compile_model)
+
+        model = _cache_device(model)
         
         return model, tokenizer
 
     @staticmethod
-    def load_finetuned_adapter(model_path):
+    def load_finetuned_adapter(model_path, dtype: str = "bf16", compile_model: bool = False):
         """
         Load a fine-tuned PEFT/LoRA adapter model from a local path using AutoPeftModelForCausalLM.
         """
@@ -202,10 +470,15 @@ class HF_Manager:
 
         # Step 1: Load the tokenizer from the fine-tuned model
         tokenizer = AutoTokenizer.from_pretrained(model_path)
+        tokenizer.padding_side = "left" # keep attention masks consistent for batched generation
 
         # Step 2: Load the fine-tuned adapter model directly
         print(f"Loading fine-tuned adapter model from {model_path}")
-        model = AutoPeftModelForCausalLM.from_pretrained(model_path, device_map="auto")
+        model = _from_pretrained(AutoPeftModelForCausalLM, model_path, 
+                                 torch_dtype=_DTYPES[dtype],
+                                 device_map="auto",
+                                 low_cpu_mem_usage=True,
+                                 )
 
         if tokenizer.pad_token is None:
             print(f"Tokenizer {tokenizer.name_or_path} does not have a pad token. Setting a unique pad token.")
@@ -225,6 +498,8 @@ class HF_Manager:
             print(f"model.config.pad_token_id: {model.config.pad_token_id}")
             print(f"model.config.eos_token_id: {model.config.eos_token_id}")
 
+        model = _maybe_compile(model, compile_model)
+        model = _cache_device(model)
 
         return model, tokenizer
     
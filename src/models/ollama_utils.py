@@ -1,18 +1,45 @@
 import os
 import time
+import random
 import ollama
+import functools
 import weave
+from concurrent.futures import ThreadPoolExecutor
 from ollama import chat, ChatResponse
 from src.models.model_mapping import model_mapping
 from src.models.query_utils import get_query_params, clean_llm_output, find_majority
 from src.data.data_manager import get_samples
 
-weave.init("model-inference-v2")
+# Weave is initialized lazily by _init_weave_once so that importing this module stays cheap
+_WEAVE_INITED = False
+
+# Separate generator for retry jitter so that retries do not shift the seeded global random state
+_BACKOFF_RNG = random.Random()
+
+def _init_weave_once():
+    """
+    Initialize Weave tracing on first use. Set DISABLE_WEAVE=1 to run without tracing.
+    """
+    global _WEAVE_INITED
+    if _WEAVE_INITED or os.environ.get("DISABLE_WEAVE", "0") == "1":
+        return
+    weave.init("model-inference-v2")
+    _WEAVE_INITED = True
+
+def get_num_parallel(num_parallel=None):
+    """
+    Number of concurrent requests to send to the Ollama server. Defaults to OLLAMA_NUM_PARALLEL, which sets how many requests the server handles in parallel, or 1 if it is unset.
+    """
+    if num_parallel is None:
+        num_parallel = int(os.environ.get("OLLAMA_NUM_PARALLEL", 1))
+    return max(1, num_parallel)
 
 def track_samples_ollama(model, dataset_name):
+    _init_weave_once()
     sample_prompts = get_samples(dataset_name)
     query_params = get_query_params(dataset_name)
     
+    # Sequential on purpose: each sample's latency is traced in Weave and should match track_samples_hf
     responses = []
     for sample_prompt in sample_prompts:
         responses.append(track_sample_ollama(model, sample_prompt, query_params))
@@ -36,6 +63,48 @@ def query_ollama_sc(model, prompt, dataset_name, verbose=False):
     
     return cleaned_response
 
+def query_ollama_batch(model, prompts, dataset_name, num_parallel=None):
+    """
+    Sends several prompts to the Ollama API concurrently and cleans the responses.
+
+    Args:
+        model (str): The name of the model to use. For example, "llama3.2:1b".
+        prompts (list): The prompts to send to the model.
+        dataset_name (str): The name of the dataset, used to select query parameters and output cleaning.
+        num_parallel (int, optional): Maximum number of concurrent requests. Defaults to OLLAMA_NUM_PARALLEL or 1.
+
+    Returns:
+        list: The cleaned responses, in the same order as the prompts.
+    """
+    if not prompts:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(get_num_parallel(num_parallel), len(prompts))) as executor:
+        return list(executor.map(lambda prompt: query_ollama_sc(model, prompt, dataset_name), prompts))
+
+def warmup_ollama_model(model, dataset_name):
+    """
+    Sends a one-token request so that Ollama loads the model weights before any real sample is timed.
+    Call it before starting the emissions tracker. It uses the same num_ctx and keep_alive as the real queries,
+    because Ollama reloads the model when num_ctx changes.
+
+    Args:
+        model (str): The name of the model to use. For example, "llama3.2:1b".
+        dataset_name (str): The name of the dataset, used to select the query parameters.
+    """
+    model_name = model_mapping.get(model, {}).get("ollama", model)
+    params = get_query_params(dataset_name)
+
+    options = {"num_predict": 1}
+    if params.get("max_context_length") is not None:
+        options["num_ctx"] = params.get("max_context_length")
+
+    try:
+        chat(model=model_name, messages=[{"role": "user", "content": "ok"}], options=options, keep_alive=params.get("keep_alive", "30m"))
+        print(f"Warmed up Ollama model {model_name}.")
+    except Exception as e:
+        print(f"Failed to warm up Ollama model {model_name}: {e}")
+
 def query_ollama_model(model, prompt, params):
     """
     Sends a chat request to the Ollama API with the given model and prompt using the Ollama SDK.
@@ -46,7 +115,8 @@ def query_ollama_model(model, prompt, params):
         temperature (float, optional): The temperature to use for sampling. Defaults to 0.1.
         seed (int, optional): The seed for reproducibility. Defaults to 42.
         max_retries (int, optional): Maximum number of retries on failure. Defaults to 3.
-        retry_delay (int, optional): Delay between retries in seconds. Defaults to 5.
+        retry_delay (int, optional): Base delay between retries in seconds, doubled on every attempt. Defaults to 5.
+        keep_alive (str, optional): How long Ollama keeps the model loaded between requests. Defaults to "30m".
 
     Returns:
         str or None: The response content if the request was successful, None otherwise.
@@ -67,13 +137,15 @@ def query_ollama_model(model, prompt, params):
 
     max_retries = params.get("custom_max_retries")
     retry_delay = params.get("custom_retry_delay")
+    keep_alive = params.get("keep_alive", "30m")
     
     for attempt in range(max_retries):
         try:
             response: ChatResponse = chat(
                 model=model_name,
                 messages=messages,
-                options=options
+                options=options,
+                keep_alive=keep_alive
             )
             return response.message.content
         except Exception as e:
@@ -81,7 +153,8 @@ def query_ollama_model(model, prompt, params):
             if attempt == max_retries - 1:
                 print("Failed to get response from Ollama after multiple attempts.")
                 return None
-            time.sleep(retry_delay)
+            # Exponential backoff with jitter so that concurrent requests do not retry in lockstep
+            time.sleep(retry_delay * (2 ** attempt) * (0.5 + _BACKOFF_RNG.random()))
 
 def use_ollama(model_name: str) -> bool:
     """
@@ -98,6 +171,13 @@ def use_ollama(model_name: str) -> bool:
     else:
         return True
 
+@functools.lru_cache(maxsize=1)
+def _list_ollama_models():
+    """
+    Names of the models available in the local Ollama server. Cached for the process run and cleared after a pull.
+    """
+    return frozenset(model.model for model in ollama.list().models)
+
 def check_if_ollama_model_exists(model_name):
     """
     Checks if a model exists in the Ollama API.
@@ -111,18 +191,11 @@ def check_if_ollama_model_exists(model_name):
     # Try to get the value from the mapping, otherwise continue with original model_name
     model_name = model_mapping.get(model_name, {}).get("ollama", model_name)
     try:
-        list = ollama.list()
-        if len(list.models) == 0:
-            print("No ollama models available yet. Pulling...")
-            pull_model_from_ollama(model_name)
-            return False
-        for model in list:
-            if model[1][0].model == model_name:
-                return True
-            else:
-                print(f"Model {model_name} not found in Ollama. Attempting to pull model.")
-                pull_model_from_ollama(model_name)
-                return False
+        if model_name in _list_ollama_models():
+            return True
+        print(f"Model {model_name} not found in Ollama. Attempting to pull model.")
+        pull_model_from_ollama(model_name)
+        return False
     except Exception as e:
         print(f"Failed to check if model {model_name} exists: {e}")
         return False
@@ -136,6 +209,7 @@ def pull_model_from_ollama(model_name):
     """
     try:
         ollama.pull(model_name)
+        _list_ollama_models.cache_clear()
         print(f"Model {model_name} pulled successfully.")
     except Exception as e:
         print(f"Failed to pull model {model_name}: {e}")
\ No newline at end of file
@@ -1,27 +1,83 @@
 import re
 import json
 import random
-from collections import Counter
+import functools
 
 from src.config.query_config import *
 
+# Precompiled patterns for clean_llm_output_summary
+_BULLET_COUNT_RE = re.compile(r'^.*?\d+\s+bullet points?.*$', re.IGNORECASE | re.MULTILINE)
+_HEADLINE_RE = re.compile(r'^.*?(bullet points?|summary|summariz|key points|important facts).*?(?:\.|\:|\n)', re.IGNORECASE | re.MULTILINE)
+_MARKDOWN_HEADER_RE = re.compile(r'^#+\s+.*$', re.MULTILINE)
+_BULLET_MARKER_RE = re.compile(r'^\s*[\*\-•]\s*', re.MULTILINE)
+_ENUMERATION_RE = re.compile(r'^\s*\d+\.\s+', re.MULTILINE)
+_BACKTICKS_RE = re.compile(r'`+')
+_EXCESS_NEWLINES_RE = re.compile(r'\n{3,}')
+
+def _alternation(phrases):
+    # Longest phrases first so that a phrase is not cut short by one of its prefixes
+    return "|".join(re.escape(p) for p in sorted(set(phrases), key=len, reverse=True))
+
+# Remove anything in the response after these phrases
+_PHRASES_REMOVE_ALL_AFTER = ["Here is the response in the correct format:"]
+_PHRASES_REMOVE_ALL_AFTER_RE = re.compile(rf'(?:{_alternation(_PHRASES_REMOVE_ALL_AFTER)}).*\Z', re.IGNORECASE | re.DOTALL)
+
+# Remove anything in a line after these phrases
+_PHRASES_REMOVE_LINE = [
+    "(Note:"
+]
+_PHRASES_REMOVE_LINE_RE = re.compile(rf'(?:{_alternation(_PHRASES_REMOVE_LINE)}).*$', re.IGNORECASE | re.DOTALL)
+
+# Remove specific phrases that are common in LLM outputs of summaries
+_PHRASES_REMOVE = [
+    "i hope it is correct", 
+    "please let me know if", 
+    "(Note: I added the last point as it was not in the format you requested)", 
+    "Here is the corrected response:", 
+    "(Note: I added the last point as it was not in", 
+    "I hope this is what you were looking for.", 
+    "$0.00",
+    "$$",
+    "Here is the corrected response:",
+    ]
+_PHRASES_REMOVE_RE = re.compile(_alternation(_PHRASES_REMOVE), re.IGNORECASE)
+
+# Mapping and precompiled word patterns for clean_llm_output_sentiment
+_SENTIMENT_MAPPING = {
+    "negative": 0,
+    "neutral": 1,
+    "positive": 2
+}
+_SENTIMENT_WORD_RES = {word: re.compile(rf'\b{word}\b') for word in _SENTIMENT_MAPPING}
+
+# Precompiled patterns for clean_llm_output_gold
+_CODE_BLOCK_RE = re.compile(r'```(?:json|python)?\s*|\s*```')
+_KEY_VALUE_RE = re.compile(r'"?(\w+)"?\s*:\s*(-?\d+)')
+
+# Dataset families, checked in this order against the dataset name (e.g. "sentiment:50agree" -> "sentiment")
+_FAMILIES = ("sentiment", "gold", "summary")
+
+@functools.lru_cache(maxsize=None)
+def get_dataset_family(dataset_name: str):
+    """
+    Resolve a dataset name to its family.
+
+    Args:
+        dataset_name (str): The name of the dataset, e.g. "sentiment:50agree".
+
+    Returns:
+        str: One of "sentiment", "gold" or "summary".
+    """
+    for family in _FAMILIES:
+        if family in dataset_name:
+            return family
+    raise ValueError(f"Unknown dataset: {dataset_name}")
+
 def get_query_params(dataset_name: str):
-    if "sentiment" in dataset_name:
-        return query_params_sentiment
-    elif "gold" in dataset_name:
-        return query_params_gold
-    elif "summary" in dataset_name:
-        return query_params_summary
-    else:
-        raise ValueError(f"Unknown dataset: {dataset_name}")
+    return _QUERY_PARAMS[get_dataset_family(dataset_name)]
 
 def find_majority(responses, dataset_name):
-    if "sentiment" in dataset_name: # list of strings
-        return find_majority_str(responses)
-    elif "gold" in dataset_name: # list of dicts
-        return find_majority_dict(responses)
-    elif "summary" in dataset_name: # list of strings
-        return find_majority_str(responses)
+    return _MAJORITY[get_dataset_family(dataset_name)](responses)
 
 def find_majority_str(responses):
     """
@@ -33,10 +89,19 @@ def find_majority_str(responses):
     Returns:
         str: The majority string.
     """
-    counter = Counter(responses)
-    majority = counter.most_common(1)[0]
-    if majority[1] > len(responses) / 2:
-        return majority[0]
+    # Fast path: all responses agree
+    if responses and all(response == responses[0] for response in responses[1:]):
+        return responses[0]
+
+    counts = {}
+    best_response, best_count = None, -1
+    for response in responses:
+        count = counts[response] = counts.get(response, 0) + 1
+        if count > best_count:
+            best_response, best_count = response, count
+
+    if best_count * 2 > len(responses):
+        return best_response
     else:
         return random.choice(responses)
 
@@ -50,34 +115,41 @@ def find_majority_dict(responses):
     Returns:
         dict: Dictionary with the values of the majority for each key.
     """
-    # Initialize a dictionary to hold the majority values
-    majority_dict = {}
+    # Fast path: all responses agree
+    if responses and all(response == responses[0] for response in responses[1:]):
+        return dict(responses[0])
+
+    # Per key: all values seen, their counts and the most frequent value so far
+    values_per_key = {}
+    counts_per_key = {}
+    best_per_key = {}
     
     # Iterate through each dictionary in the list
     for response in responses:
         for key, value in response.items():
-            if key not in majority_dict:
-                majority_dict[key] = []
-            majority_dict[key].append(value)
+            if key not in values_per_key:
+                values_per_key[key] = []
+                counts_per_key[key] = {}
+                best_per_key[key] = (None, -1)
+            values_per_key[key].append(value)
+            counts = counts_per_key[key]
+            count = counts[value] = counts.get(value, 0) + 1
+            if count > best_per_key[key][1]:
+                best_per_key[key] = (value, count)
     
     # Find the majority for each key
-    for key, values in majority_dict.items():
-        counter = Counter(values)
-        majority = counter.most_common(1)[0]
-        if majority[1] > len(values) / 2:
-            majority_dict[key] = majority[0]
+    majority_dict = {}
+    for key, values in values_per_key.items():
+        best_value, best_count = best_per_key[key]
+        if best_count * 2 > len(values):
+            majority_dict[key] = best_value
         else:
             majority_dict[key] = random.choice(values)
     
     return majority_dict
 
 def clean_llm_output(dataset_name, text: str):
-    if "sentiment" in dataset_name:
-        return clean_llm_output_sentiment(text)
-    elif "gold" in dataset_name:
-        return clean_llm_output_gold(text)
-    elif "summary" in dataset_name:
-        return clean_llm_output_summary(text)
+    return _CLEANERS[get_dataset_family(dataset_name)](text)
 
 def clean_llm_output_summary(text: str):
     """
@@ -91,53 +163,35 @@ def clean_llm_output_summary(text: str):
     """
 
     # Remove lines with numeric bullet point references (e.g., "5 bullet points")
-    cleaned_text = re.sub(r'(?im)^.*?\d+\s+bullet points?.*$', '', text)
+    cleaned_text = _BULLET_COUNT_RE.sub('', text)
 
     # Remove headline patterns that typically introduce bullet points
     # Handle headlines ending with either period or colon
-    cleaned_text = re.sub(r'(?im)^.*?(bullet points?|summary|summariz|key points|important facts).*?(?:\.|\:|\n)', '', cleaned_text)
+    cleaned_text = _HEADLINE_RE.sub('', cleaned_text)
     
     # Remove any markdown headers (lines starting with #)
-    cleaned_text = re.sub(r'(?m)^#+\s+.*$', '', cleaned_text)
+    cleaned_text = _MARKDOWN_HEADER_RE.sub('', cleaned_text)
     
     # Remove asterisks or hyphens at the start of lines
-    cleaned_text = re.sub(r'(?m)^\s*[\*\-•]\s*', '', cleaned_text)
+    cleaned_text = _BULLET_MARKER_RE.sub('', cleaned_text)
 
     # Remove enumerated list items like "1. ..." at the start of a line
-    cleaned_text = re.sub(r'(?m)^\s*\d+\.\s+', '', cleaned_text)
+    cleaned_text = _ENUMERATION_RE.sub('', cleaned_text)
 
     # Remove any backticks or code blocks
-    cleaned_text = re.sub(r'`+', '', cleaned_text)
+    cleaned_text = _BACKTICKS_RE.sub('', cleaned_text)
 
     # Remove anything in the response after these phrases
-    phrases_remove_all_after = ["Here is the response in the correct format:"]
-    for phrase in phrases_remove_all_after:
-        cleaned_text = re.sub(rf'(?i){re.escape(phrase)}.*\Z', '', cleaned_text, flags=re.DOTALL)
+    cleaned_text = _PHRASES_REMOVE_ALL_AFTER_RE.sub('', cleaned_text)
 
     # Remove anything in a line after these phrases
-    phrases_remove_line = [
-        "(Note:"
-    ]
-    for phrase in phrases_remove_line:
-        cleaned_text = re.sub(rf'(?i){re.escape(phrase)}.*$', '', cleaned_text, flags=re.DOTALL)
+    cleaned_text = _PHRASES_REMOVE_LINE_RE.sub('', cleaned_text)
 
     # Remove specific phrases that are common in LLM outputs of summaries
-    phrases_remove = [
-        "i hope it is correct", 
-        "please let me know if", 
-        "(Note: I added the last point as it was not in the format you requested)", 
-        "Here is the corrected response:", 
-        "(Note: I added the last point as it was not in", 
-        "I hope this is what you were looking for.", 
-        "$0.00",
-        "$$",
-        "Here is the corrected response:",
-        ]
-    for phrase in phrases_remove:
-        cleaned_text = re.sub(rf'(?i){re.escape(phrase)}', '', cleaned_text)
+    cleaned_text = _PHRASES_REMOVE_RE.sub('', cleaned_text)
     
     # Clean up extra whitespace and normalize newlines
-    cleaned_text = re.sub(r'\n{3,}', '\n\n', cleaned_text)  # Replace 3+ newlines with 2
+    cleaned_text = _EXCESS_NEWLINES_RE.sub('\n\n', cleaned_text)  # Replace 3+ newlines with 2
     cleaned_text = cleaned_text.strip()  # Remove leading/trailing whitespace
     
     return cleaned_text
@@ -153,11 +207,7 @@ def clean_llm_output_sentiment(text: str):
         int: The sentiment label as integer (0=negative, 1=neutral, 2=positive) or -1 for invalid
     """
     # Define mapping for consistent return types
-    mapping = {
-        "negative": 0,
-        "neutral": 1,
-        "positive": 2
-    }
+    mapping = _SENTIMENT_MAPPING
 
     if text is None or text == "":
         print("Received None text. Marking as invalid (-1).")
@@ -169,20 +219,41 @@ def clean_llm_output_sentiment(text: str):
     if text in mapping.keys():
         return mapping[text]
     
-    words_found = []
-    
-    for word in mapping.keys():
-        words_found.extend([word] * len(re.findall(word, text)))
+    counts = {word: len(pattern.findall(text)) for word, pattern in _SENTIMENT_WORD_RES.items()}
     
-    if not words_found:
+    if sum(counts.values()) == 0:
         print("No valid sentiment found. Marking as invalid (-1).")
         return -1
     
-    # If multiple sentiment words, find the majority
-    majority_word = find_majority(words_found, dataset_name="sentiment")
+    # If multiple sentiment words, take the most frequent one. Ties go to the first word in the mapping
+    majority_word = max(counts, key=counts.get)
     return mapping[majority_word]
 
 
+def _extract_json_objects(text: str):
+    """
+    Extract all top-level {...} substrings from a text with a single linear scan over brace depth.
+
+    Args:
+        text (str): The text to scan.
+
+    Returns:
+        list: The top-level brace-delimited substrings, in order of appearance.
+    """
+    depth = 0
+    start = -1
+    objects = []
+    for i, char in enumerate(text):
+        if char == '{':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif char == '}' and depth > 0:
+            depth -= 1
+            if depth == 0:
+                objects.append(text[start:i + 1])
+    return objects
+
 def clean_llm_output_gold(input_data):
     """
     Process various input formats containing financial sentiment data and return a standardized dictionary.
@@ -216,11 +287,10 @@ def clean_llm_output_gold(input_data):
         parsed_data = input_data
     elif isinstance(input_data, str):
         # Remove markdown code blocks if present
-        clean_input = re.sub(r'```(?:json|python)?\s*|\s*```', '', input_data)
+        clean_input = _CODE_BLOCK_RE.sub('', input_data)
         
         # Try to find and extract JSON-like structure from text
-        json_pattern = r'(?:\{|\[).*?(?:\}|\])'
-        json_matches = re.findall(json_pattern, clean_input, re.DOTALL)
+        json_matches = _extract_json_objects(clean_input)
         
         if json_matches:
             # Try each potential JSON match
@@ -245,14 +315,28 @@ def clean_llm_output_gold(input_data):
                     parsed_data = json.loads(clean_input)
                 except json.JSONDecodeError:
                     # Try to extract key-value pairs using regex
-                    pairs = re.findall(r'"?(\w+)"?\s*:\s*(-?\d+)', clean_input)
+                    pairs = _KEY_VALUE_RE.findall(clean_input)
                     parsed_data = {key: int(value) for key, value in pairs}
     
-    # Update result with valid values from parsed data
-    for key in expected_keys:
-        if key in parsed_data:
-            # Ensure value is 0 or 1, otherwise set to -1
-            if parsed_data[key] in [0, 1]:
-                result[key] = parsed_data[key]
+    # Update result with valid values from parsed data. Values other than 0 or 1 stay -1
+    result.update({key: parsed_data[key] for key in expected_keys if key in parsed_data and parsed_data[key] in (0, 1)})
     
-    return result
\ No newline at end of file
+    return result
+
+_QUERY_PARAMS = {
+    "sentiment": query_params_sentiment,
+    "gold": query_params_gold,
+    "summary": query_params_summary,
+}
+
+_MAJORITY = {
+    "sentiment": find_majority_str, # list of strings
+    "gold": find_majority_dict, # list of dicts
+    "summary": find_majority_str, # list of strings
+}
+
+_CLEANERS = {
+    "sentiment": clean_llm_output_sentiment,
+    "gold": clean_llm_output_gold,
+    "summary": clean_llm_output_summary,
+}